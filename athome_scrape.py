@@ -6,8 +6,11 @@ import os
 import pandas as pd
 import random
 import warnings
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 from utils import _setup_directory, _find_file
+from characteristics_schema import CharacteristicsSchema
 
 
 # simpler warning formatting
@@ -15,6 +18,12 @@ def warning_on_one_line(message, category, filename, lineno, file=None, line=Non
     return '%s:%s: %s: %s\n' % (filename, lineno, category.__name__, message)
 warnings.formatwarning = warning_on_one_line
 
+## constants
+# residence -> child URLs cache, unit lists of collective residences rarely change between runs
+COLLECTIVE_CACHE_TTL_DAYS = 7
+# number of residence pages fetched concurrently
+COLLECTIVE_MAX_WORKERS = 8
+
 ################################################
 ### Functions to find all relevant articles
 def extract_athomelu_entries():
@@ -52,6 +61,8 @@ def extract_athomelu_entries():
     with open(filepath, 'w+') as file:
         # use a set to keep track of property ID's and ensure we don't save duplicates
         hashset_property_id = set()
+        # collective residences are expanded into their individual properties in a separate stage
+        residence_hrefs = []
         # loop through all results pages
         for i in range(1,num_result_pages+1):
             page_url = BASE_URL + f"/en/buy?page={i}" 
@@ -75,10 +86,7 @@ def extract_athomelu_entries():
                 # check if "<p>: class=childrenInfos" exists, meaning the property is collective
                 collective = bool(article.find_all('p', class_='childrenInfos'))
                 if collective:
-                    href_list = _collective_article(article, BASE_URL)
-                    url_list = [BASE_URL + href + '\n' for href in href_list]
-                    file.writelines(url_list)
-                    saved_url_counter += len(url_list)
+                    residence_hrefs.append(href)
                 else:
                     property_url = BASE_URL + _individual_article(article) + '\n'
                     file.write(property_url)
@@ -90,6 +98,12 @@ def extract_athomelu_entries():
                         print("Number of Articles parsed (URLs collected)...")
                     print(f"{parsed_article_counter} ({saved_url_counter})")
                     printcounter += 200
+
+        # expand all collective residences into the URLs of their individual properties
+        href_list = _expand_collectives(residence_hrefs, BASE_URL)
+        url_list = [BASE_URL + href + '\n' for href in href_list]
+        file.writelines(url_list)
+        saved_url_counter += len(url_list)
                 
     # close file
     file.close()
@@ -112,12 +126,83 @@ def _individual_article(article):
 
     return article.find('link', itemprop='url')['href']
 
-def _collective_article(article, BASE_URL):
+def _expand_collectives(residence_hrefs, BASE_URL):
+    """Returns a list of href strings corresponding to each property included in any of the collective residences.
+        Residences are fetched concurrently, and their children are cached in 'cache/collective_residences.json'
+        so residences fetched less than COLLECTIVE_CACHE_TTL_DAYS ago cost no requests."""
+
+    cache = _load_collective_cache()
+    now = time.time()
+    ttl_seconds = COLLECTIVE_CACHE_TTL_DAYS * 24 * 3600
+    to_fetch = [href for href in set(residence_hrefs)
+                if (href not in cache) or (now - cache[href]['fetched_at'] > ttl_seconds)]
+    print(f"Expanding {len(residence_hrefs)} collective residences ({len(residence_hrefs) - len(to_fetch)} cached, {len(to_fetch)} to fetch).")
+
+    def _fetch(href):
+        try:
+            return href, _collective_article(href, BASE_URL)
+        except Exception as e:
+            warnings.warn(f'\nCould not expand collective residence {href}: {e}')
+            return href, None
+
+    with ThreadPoolExecutor(max_workers=COLLECTIVE_MAX_WORKERS) as executor:
+        for href, children in executor.map(_fetch, to_fetch):
+            # on failure keep whatever (possibly expired) children were cached before
+            if children is None:
+                continue
+            # an empty unit list usually means a layout change or a soft error page, don't cache it
+            if not children:
+                warnings.warn(f'\nCollective residence {href} has no units, not caching it.')
+                continue
+            cache[href] = {'fetched_at': now, 'children': children}
+
+    # prune residences which are no longer listed and whose entries have expired anyway
+    listed = set(residence_hrefs)
+    cache = {href: entry for href, entry in cache.items()
+             if (href in listed) or (now - entry['fetched_at'] <= ttl_seconds)}
+
+    _save_collective_cache(cache)
+
+    href_list = []
+    for href in residence_hrefs:
+        if href in cache:
+            href_list.extend(cache[href]['children'])
+    
+    return href_list
+
+def _collective_cache_path():
+    return os.path.dirname(os.path.abspath(__file__)) + '/cache/collective_residences.json'
+
+def _load_collective_cache():
+    """Returns the persisted residence href -> {'fetched_at', 'children'} dictionary, empty if there is none yet."""
+
+    cache_path = _collective_cache_path()
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, 'r') as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        warnings.warn(f'\nCollective residence cache ({cache_path}) is corrupted, starting from an empty cache.')
+        return {}
+
+def _save_collective_cache(cache):
+    """Writes the cache to a temporary file first, so an interrupted write never leaves a half-written cache."""
+
+    cache_path = _collective_cache_path()
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, cache_path)
+
+def _collective_article(residence_href, BASE_URL):
     """Returns a list of href strings corresponding to each property included in the collective."""
 
     # Extract collective property page's URLs to each individual property
-    col_prop_page_url = BASE_URL + article.find_all('link', itemprop='url')[0]['href']
+    col_prop_page_url = BASE_URL + residence_href
     collective_page = requests.get(col_prop_page_url)
+    if collective_page.status_code != 200:
+        raise Exception(f'Status code: {collective_page.status_code}')
     collective_soup = BeautifulSoup(collective_page.content, 'html.parser')
     property_divs = collective_soup.find_all('div', class_='residence-informations-content')
     
@@ -143,6 +228,8 @@ def get_data():
     batch_st_time = st_time
     # find the most up to date set of URLs
     target_filepath, target_timestamp = _find_file('extracted_URLs')
+    # maps characteristic labels to canonical column names and parses their values
+    schema = CharacteristicsSchema()
 
     # get the relevant information from each advert
     headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36'}
@@ -169,12 +256,13 @@ def get_data():
             # get everything in the characteristics block of the page
             try:
                 _characteristics_container_div = page_soup.find('div', class_='characteristics-container')
-                characteristics_dict = _scan_characteristics_block(_characteristics_container_div)
+                characteristics_dict = _scan_characteristics_block(_characteristics_container_div, schema)
             except:
                 print(f"URL number {i+1} might have no info.")
             else:
-                characteristics_dict['Property Type'] = type_of_property
-                characteristics_dict['Locality'] = locality
+                for label, value in [('Property Type', type_of_property), ('Locality', locality)]:
+                    name, typed_value = schema.parse(label, value)
+                    characteristics_dict[name] = typed_value
 
                 data.append(characteristics_dict)
 
@@ -186,6 +274,11 @@ def get_data():
 
     file.close()
 
+    # persist any characteristics seen for the first time, flagged for review
+    if schema.new_labels:
+        schema.save()
+        print(f"{len(schema.new_labels)} new characteristics added to '{schema.path}' for review: {schema.new_labels}")
+
     # turn the whole thing into a dataframe to save it as a CSV for future reference
     df = pd.DataFrame(data)
     csv_path = os.path.dirname(os.path.abspath(__file__)) + '/raw_datasets/' + f'data_{target_timestamp}.csv'
@@ -197,7 +290,9 @@ def get_data():
 
     return
 
-def _scan_characteristics_block(container):
+def _scan_characteristics_block(container, schema=None):
+    """Returns a dictionary of every characteristic on the page. If a CharacteristicsSchema is provided,
+        keys are canonical column names and values are parsed into typed values, otherwise both are the raw text."""
 
     blocks = container.find_all('div', class_='characteristics-block')
     data = {}
@@ -207,6 +302,8 @@ def _scan_characteristics_block(container):
         for child in block_direct_children[1:]:
             label = child.find('span', class_='characteristics-item-label').text.strip()
             value = child.find('span', class_='characteristics-item-value').text.strip()
+            if schema is not None:
+                label, value = schema.parse(label, value)
             data[label] = value
     
     return data
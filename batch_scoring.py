@@ -0,0 +1,273 @@
+import os
+import time
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import numpy as np
+import pandas as pd
+
+from utils import _setup_directory, _find_file, ScikitModel
+from lite_runtime import load_lite_model
+from characteristics_schema import CharacteristicsSchema
+from data_preprocessing import (label_based_cleaning, format_feature_data, encode_categoricals,
+                                impute_numericals, FEATURES_TO_REMOVE)
+
+## constants
+# number of raw CSV rows read, cleaned and encoded at once, bounds memory use regardless of snapshot size
+SCORING_CHUNK_SIZE = 20000
+# number of rows passed to a single model.predict() call
+PREDICT_BATCH_SIZE = 4096
+
+
+def save_scoring_bundle(model: Optional[ScikitModel],
+                        encoders: dict[str, object],
+                        impute_map: dict[str, pd.Series],
+                        feature_columns: list[str],
+                        timestamp: str,
+                        model_path: Optional[str] = None) -> str:
+    """
+    Saves everything needed to score a raw snapshot to 'models/bundle_{timestamp}.pkl'.
+
+    Parameters
+    ----------
+    model: Optional[ScikitModel]
+        Fitted model with a .predict() method. Must be picklable. Can be None if model_path is provided.
+    encoders: dict[str, object]
+        Fitted encoders, as passed to data_preprocessing.encode_categoricals.
+    impute_map: dict[str, pd.Series]
+        Imputation values, as passed to data_preprocessing.impute_numericals.
+    feature_columns: list[str]
+        Columns (and their order) of the feature matrix the model was trained on.
+    timestamp: str
+        Timestamp of the clean dataset the model was trained on.
+    model_path: Optional[str]
+        Name of a model exported with model_export.py (.npz or .tflite) in 'models/', loaded with
+        lite_runtime instead of pickling the model. Avoids importing TensorFlow when scoring Keras models.
+        The model must take unscaled features (see model_export.py) and be trained on the features built by
+        data_preprocessing. model_pipeline.bingobango() builds different ones (one-hot columns, binned years,
+        an OrdinalEncoder that isn't saved), so its exports can't be scored this way.
+
+    Returns
+    -------
+    str
+        Path of the saved bundle.
+    """
+
+    _setup_directory()
+
+    if (model is None) == (model_path is None):
+        raise Exception('Provide exactly one of model and model_path.')
+
+    bundle = {
+        'model': model,
+        'model_path': model_path,
+        'encoders': encoders,
+        'impute_map': impute_map,
+        'feature_columns': list(feature_columns),
+    }
+    bundle_path = os.path.dirname(os.path.abspath(__file__)) + f'/models/bundle_{timestamp}.pkl'
+    with open(bundle_path, 'wb') as f:
+        pickle.dump(bundle, f)
+
+    return bundle_path
+
+def _load_scoring_bundle(file: Optional[str] = None) -> dict[str, object]:
+    """Loads the requested scoring bundle from 'models/', or the most recent one if none is requested."""
+
+    models_dir = os.path.dirname(os.path.abspath(__file__)) + '/models/'
+    # models/ also holds the SavedModel directories, so only look at bundle files
+    if not file:
+        bundles = [x for x in os.listdir(models_dir) if x.startswith('bundle_') and x.endswith('.pkl')]
+        if not len(bundles):
+            raise Exception(f'No scoring bundles exist in {models_dir}')
+        file = max(bundles, key=lambda x: int(x.split('_')[-1][:-4]))
+
+    bundle_path, _ = _find_file('models', file)
+    with open(bundle_path, 'rb') as f:
+        bundle = pickle.load(f)
+
+    # exported models are stored separately and loaded without TensorFlow
+    if bundle.get('model_path'):
+        bundle['model'] = load_lite_model(models_dir + bundle['model_path'])
+
+    return bundle
+
+def _drop_unseen_categories(df: pd.DataFrame, encoders: dict[str, object]) -> pd.DataFrame:
+    """
+    Drops records with categories the encoders were not fitted on, for encoders which would raise on them
+    (handle_unknown='error', the sklearn default), so a single unusual listing can't fail the whole job.
+    """
+
+    mask = pd.Series(True, index=df.index)
+    for encoder in encoders.values():
+        if getattr(encoder, 'handle_unknown', 'error') != 'error':
+            continue
+        for colname, categories in zip(encoder.feature_names_in_, encoder.categories_):
+            mask &= df[colname].isin(categories)
+
+    return df[mask]
+
+def _prepare_chunk(chunk: pd.DataFrame, 
+                   bundle: dict[str, object], 
+                   schema: CharacteristicsSchema) -> tuple[np.ndarray, pd.DataFrame, int, int]:
+    """
+    Runs a chunk of raw scraped data through the cleaning, imputation and encoding stages.
+    Returns the feature matrix, aligned to the bundle's feature columns, a DF holding the identifying
+    columns and asking price of each remaining record, the number of records dropped for having
+    categories unseen during training and the number dropped for still having missing features.
+    """
+
+    df = label_based_cleaning(chunk, schema=schema, verbose=False)
+    # keep the index so each score can be traced back to its row in the raw snapshot
+    id_df = df[['property_type', 'locality', 'sale_price']].copy()
+
+    df = df.drop(['sale_price'] + FEATURES_TO_REMOVE, axis=1, errors='ignore')
+    df = format_feature_data(df, schema=schema, verbose=False)
+    n_cleaned = len(df)
+    df = _drop_unseen_categories(df, bundle['encoders'])
+    n_unseen = n_cleaned - len(df)
+
+    # impute every mapped column, whatever the chunk happens to contain (even nothing at all)
+    impute_map = bundle['impute_map']
+    for colname in impute_map:
+        if colname not in df.columns:
+            df[colname] = np.nan
+    df = impute_numericals(df, impute_map, columns=list(impute_map))
+    df = encode_categoricals(df, bundle['encoders'])
+
+    # missing flag columns only exist for chunks that actually had missing data, default them to 0
+    feature_columns = bundle['feature_columns']
+    absent = [col for col in feature_columns if (col not in df.columns) and not col.endswith('_missingflag')]
+    if absent:
+        raise Exception(f'Features {absent} cannot be built from this snapshot.')
+    df = df.reindex(columns=feature_columns)
+    flag_columns = [col for col in feature_columns if col.endswith('_missingflag')]
+    df[flag_columns] = df[flag_columns].fillna(0)
+
+    # records with features that could not be filled in would get NaN predictions, skip them instead
+    complete_mask = df.notna().all(axis=1)
+    n_incomplete = int((~complete_mask).sum())
+    df = df[complete_mask]
+    X = df.to_numpy(dtype=float)
+
+    id_df = id_df.loc[df.index]
+    output_df = pd.DataFrame({
+        'source_row': id_df.index.values,
+        'property_type': id_df['property_type'].values,
+        'locality': id_df['locality'].values,
+        'sale_price': id_df['sale_price'].values,
+    })
+
+    return X, output_df, n_unseen, n_incomplete
+
+def _predict_parallel(model: ScikitModel, X: np.ndarray, batch_size: int, n_threads: int) -> np.ndarray:
+    """Splits X into batches of batch_size rows and predicts them on n_threads threads."""
+
+    batches = [X[start:start+batch_size] for start in range(0, len(X), batch_size)]
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        # ravel since keras models return an (n, 1) array
+        batch_preds = list(executor.map(lambda batch: np.asarray(model.predict(batch)).ravel(), batches))
+
+    return np.concatenate(batch_preds) if batch_preds else np.empty(0)
+
+def score_snapshot(file: Optional[str] = None,
+                   bundle_file: Optional[str] = None,
+                   chunk_size: int = SCORING_CHUNK_SIZE,
+                   batch_size: int = PREDICT_BATCH_SIZE,
+                   n_threads: Optional[int] = None) -> str:
+    """
+    Scores an entire raw snapshot ('raw_datasets/data_{timestamp}.csv') with a trained model and writes the
+    predicted prices and residuals (asking price - predicted price) to 'scored_datasets/scores_{timestamp}.parquet'.
+    The snapshot is streamed in chunks of chunk_size rows, so memory stays bounded regardless of its size.
+
+    Parameters
+    ----------
+    file: Optional[str]
+        Name of the raw snapshot to score. Most recent one if not provided.
+    bundle_file: Optional[str]
+        Name of the scoring bundle in 'models/' (see save_scoring_bundle). Most recent one if not provided.
+    chunk_size: int
+        Number of raw rows processed at once.
+    batch_size: int
+        Number of rows passed to a single model.predict() call.
+    n_threads: Optional[int]
+        Number of threads running predictions. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    str
+        Path of the written parquet file.
+    """
+
+    # pyarrow is only needed for this job, so it is not a hard requirement of the project
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('Batch scoring requires pyarrow to write parquet output: pip install pyarrow')
+
+    # quick setup
+    _setup_directory()
+
+    st_time = time.time()
+    n_threads = n_threads or os.cpu_count() or 1
+    source_filepath, source_timestamp = _find_file('raw_datasets', file)
+    if not source_timestamp:
+        source_timestamp = source_filepath.split('_')[-1][:-4]
+    bundle = _load_scoring_bundle(bundle_file)
+    # column types come from the registry, so chunks don't need their types rediscovered one by one
+    schema = CharacteristicsSchema()
+
+    output_path = os.path.dirname(os.path.abspath(__file__)) + f'/scored_datasets/scores_{source_timestamp}.parquet'
+    # write to a temporary file first, so a failed run never leaves a truncated file that looks complete
+    tmp_path = output_path + '.tmp'
+    writer = None
+    succeeded = False
+    n_read = 0
+    n_scored = 0
+    n_unseen = 0
+    n_incomplete = 0
+    print('Rows read (rows scored, rows/s)...')
+    try:
+        for chunk in pd.read_csv(source_filepath, chunksize=chunk_size):
+            n_read += len(chunk)
+            X, output_df, chunk_unseen, chunk_incomplete = _prepare_chunk(chunk, bundle, schema)
+            n_unseen += chunk_unseen
+            n_incomplete += chunk_incomplete
+            if not len(output_df):
+                continue
+
+            output_df['predicted_price'] = _predict_parallel(bundle['model'], X, batch_size, n_threads)
+            output_df['residual'] = output_df['sale_price'] - output_df['predicted_price']
+
+            table = pa.Table.from_pandas(output_df, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema)
+            writer.write_table(table.cast(writer.schema))
+            n_scored += len(output_df)
+
+            print(f"{n_read} ({n_scored}, {round(n_read / (time.time() - st_time), 1)})")
+        succeeded = True
+    finally:
+        if writer is not None:
+            writer.close()
+        if not succeeded and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    et_time = time.time()
+    if writer is None:
+        raise Exception(f'No valid records to score in {source_filepath}.')
+    os.replace(tmp_path, output_path)
+    print(f"Scored {n_scored} of {n_read} records, wrote them to file with path '{output_path}'.")
+    if n_unseen:
+        print(f"Skipped {n_unseen} records with categories unseen during training.")
+    if n_incomplete:
+        print(f"Skipped {n_incomplete} records with missing features that could not be imputed.")
+    print(f"This process took {round(et_time - st_time, 2)} seconds ({round(n_read / (et_time - st_time), 1)} rows/s).")
+
+    return output_path
+
+
+if __name__ == '__main__':
+    score_snapshot()
+    pass
@@ -0,0 +1,202 @@
+import os
+import re
+import json
+import warnings
+from typing import Iterable
+import numpy as np
+import pandas as pd
+
+## constants
+SCHEMA_PATH = os.path.dirname(os.path.abspath(__file__)) + '/characteristics_schema.json'
+# area columns are sometimes filled with "Yes" instead of a surface value, parsed into this marker so it
+# can be told apart from a missing characteristic (the former gets imputed, the latter means no garden/terrace)
+AREA_UNSPECIFIED = -1.0
+AREA_TYPES = ('area_m2', 'area_ares')
+
+
+def _canonical_name(label: str) -> str:
+    """Lowercase, underscores instead of spaces and no "(s)" at the end, as label_based_cleaning always did."""
+    return label.replace(' ', '_').lower().replace('(s)', '')
+
+def _parse_text(value):
+    return value
+
+def _parse_numeric(value):
+    if not isinstance(value, str):
+        return value
+    digits = re.sub(r'[^0-9.\-]', '', value.replace(',', ''))
+    try:
+        return float(digits)
+    except ValueError:
+        return np.nan
+
+def _parse_price(value):
+    if not isinstance(value, str):
+        return value
+    try:
+        return float(re.sub(r'[€,\s]', '', value))
+    except ValueError:
+        return np.nan
+
+def _parse_class(value):
+    """Keeps only the letter grading (some specified as "196.1E", keep only "E"), anything longer is a missing value."""
+    if not isinstance(value, str):
+        return value
+    letters = re.sub('[^a-zA-Z]', '', value)
+    return letters if len(letters) == 1 else np.nan
+
+def _parse_yesno(value):
+    if not isinstance(value, str):
+        return value
+    return float(value.lower() == 'yes')
+
+def _parse_area_m2(value):
+    if not isinstance(value, str):
+        return value
+    if value.lower() == 'yes':
+        return AREA_UNSPECIFIED
+    try:
+        return float(re.sub(r' m²|m|,', '', value))
+    except ValueError:
+        return np.nan
+
+def _parse_area_ares(value):
+    if not isinstance(value, str):
+        return value
+    try:
+        return float(re.sub(r' ares|,', '', value))
+    except ValueError:
+        return np.nan
+
+# column type -> parser turning the raw scraped string into a typed value, NaNs are passed through
+PARSERS = {
+    'text': _parse_text,
+    'numeric': _parse_numeric,
+    'price': _parse_price,
+    'class': _parse_class,
+    'yesno': _parse_yesno,
+    'area_m2': _parse_area_m2,
+    'area_ares': _parse_area_ares,
+}
+
+def _infer_type(label: str, values: Iterable) -> str:
+    """Guesses the type of a new characteristic from its label and some of its raw values."""
+
+    values = [str(x) for x in values if isinstance(x, str)]
+    if any('m²' in x for x in values):
+        return 'area_m2'
+    if any('ares' in x for x in values):
+        return 'area_ares'
+    if 'class' in label.lower():
+        return 'class'
+    if any('€' in x for x in values):
+        return 'price'
+    if values and all(x.lower() == 'yes' for x in values):
+        return 'yesno'
+    if values and all(not np.isnan(_parse_numeric(x)) for x in values):
+        return 'numeric'
+    return 'text'
+
+
+class CharacteristicsSchema:
+    """
+    Persisted registry mapping the raw characteristic labels shown on atHome.lu to canonical column names,
+    column types and parsers (see PARSERS). Stored in 'characteristics_schema.json' as
+    {raw_label: {'name': ..., 'type': ..., 'review': ...}}.
+    Labels not in the registry are registered automatically with a suggested type and flagged for review
+    ('review': true) until someone checks them and sets the flag to false.
+    Values of labels awaiting review are kept as raw text at scrape time, since a type guessed from the first
+    value seen can be wrong (e.g. a "Yes" balcony followed by "8 m²" ones). Downstream, parse_frame
+    infers their type from the whole column instead, once per instance so every chunk of a snapshot
+    is parsed the same way.
+    """
+
+    def __init__(self, path: str = SCHEMA_PATH) -> None:
+        self.path = path
+        self.labels: dict[str, dict[str, object]] = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.labels = json.load(f)
+        # canonical name -> entry, so labels differing only in case/spacing map to the same column
+        self._by_name = {entry['name']: entry for entry in self.labels.values()}
+        self.new_labels: list[str] = []
+        # names of labels awaiting review whose type was already inferred from a whole column, kept fixed afterwards
+        self._inferred: set[str] = set()
+
+    def save(self) -> None:
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(self.labels, f, indent=4, ensure_ascii=False, sort_keys=True)
+
+    def register(self, label: str, values: Iterable = ()) -> dict[str, object]:
+        """Returns the registry entry for label, registering (and flagging) it first if it is unknown."""
+
+        if label in self.labels:
+            return self.labels[label]
+        name = _canonical_name(label)
+        # labels differing only in case/spacing, or already canonical column names, reuse the existing entry
+        if name in self._by_name:
+            return self._by_name[name]
+
+        entry = {'name': name, 'type': _infer_type(label, values), 'review': True}
+        self.labels[label] = entry
+        self._by_name[name] = entry
+        self.new_labels.append(label)
+        warnings.warn(f"\nNew characteristic '{label}' registered as '{name}' ({entry['type']}), flagged for review.")
+        return entry
+
+    def parse(self, label: str, value) -> tuple[str, object]:
+        """Returns the canonical name and typed value of a single scraped characteristic (raw if awaiting review)."""
+
+        entry = self.register(label, [value])
+        if entry['review']:
+            return entry['name'], value
+        return entry['name'], PARSERS[entry['type']](value)
+
+    def _lookup(self, label: str) -> dict[str, object] | None:
+        return self.labels.get(label) or self._by_name.get(_canonical_name(label))
+
+    def canonical_name(self, label: str) -> str:
+        entry = self._lookup(label)
+        return entry['name'] if entry else _canonical_name(label)
+
+    def columns_of_type(self, column_type: str) -> list[str]:
+        return sorted({entry['name'] for entry in self.labels.values() if entry['type'] == column_type})
+
+    def parse_frame(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Renames the columns of a DF to their canonical names and parses them into typed values.
+        Meant for raw snapshots scraped before parsing happened at scrape time, and for columns still
+        awaiting review (kept raw at scrape time). Columns that are already typed (numeric) are left as
+        they are, so it is safe to call on any snapshot.
+        The suggested type of labels awaiting review is re-inferred from all of the column's values the first
+        time this instance sees them, and kept for later frames (e.g. the other chunks of the same snapshot).
+        """
+
+        renames = {}
+        for colname in list(df.columns):
+            colseries = df[colname]
+            entry = self._lookup(colname)
+            if entry is None:
+                # only unknown labels need their values to suggest a type
+                entry = self.register(colname, colseries.dropna().unique())
+                self._inferred.add(entry['name'])
+            renames[colname] = entry['name']
+            if colseries.dtype != object:
+                continue
+
+            if entry['review'] and (entry['name'] not in self._inferred):
+                inferred_type = _infer_type(colname, colseries.dropna().unique())
+                # a surface column stays a surface column, even if this frame only has "Yes" values for it
+                if not ((entry['type'] in AREA_TYPES) and (inferred_type == 'yesno')):
+                    entry['type'] = inferred_type
+                self._inferred.add(entry['name'])
+            if entry['type'] == 'text':
+                continue
+            # class columns parsed at scrape time already hold single letters, no need to parse them again
+            if (entry['type'] == 'class') and (colseries.isna() | colseries.str.fullmatch('[a-zA-Z]', na=False)).all():
+                continue
+            df[colname] = colseries.map(PARSERS[entry['type']])
+            if entry['type'] != 'class':
+                df[colname] = df[colname].astype(float)
+
+        return df.rename(columns=renames)
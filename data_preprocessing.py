@@ -4,6 +4,8 @@ import warnings
 warnings.simplefilter(action='ignore', category=pd.errors.PerformanceWarning) # remove some useless pandas warnings
 import numpy as np
 import datetime
+from functools import lru_cache
+from typing import Optional
 import matplotlib.pyplot as plt
 
 # for encoding categorical variables
@@ -11,6 +13,10 @@ from sklearn.preprocessing import OneHotEncoder, OrdinalEncoder
 
 # helper to find most recent files
 from utils import _find_file
+# opt-in instrumentation of the preprocessing stages
+from stage_profiling import StageProfiler, NULL_PROFILER
+# registry of characteristic labels, canonical names and types
+from characteristics_schema import CharacteristicsSchema, AREA_UNSPECIFIED
 
 ## constants
 SALE_PRICE_CUTOFF = 140000
@@ -66,17 +72,38 @@ USELESS_FEATURES = [
 FEATURES_TO_REMOVE = OVERLY_SPARSE_FEATURES + USELESS_FEATURES
 
 
-def label_based_cleaning(df: pd.DataFrame) -> pd.DataFrame:
+def _log(message: str, verbose: bool) -> None:
+    """Prints message only if verbose, lets callers silence the stage reports."""
+    if verbose:
+        print(message)
+
+@lru_cache(maxsize=1)
+def _default_schema() -> CharacteristicsSchema:
+    """Registry used when no schema is passed, shared so types inferred while cleaning are seen when formatting."""
+    return CharacteristicsSchema()
+
+
+def label_based_cleaning(df: pd.DataFrame, 
+                         schema: Optional[CharacteristicsSchema] = None, 
+                         profiler: Optional[StageProfiler] = None, 
+                         verbose: bool = True) -> pd.DataFrame:
     """
     0th step of removing invalid data and reformatting labels before splitting labels from features.
     Removes records with Null labels as well as those with invalid localities.
-    Makes all column names lowercase and swaps whitespaces with underscores.
-    Converts string label values into numerical values (float).
+    Renames columns to their canonical names (lowercase, underscores instead of whitespaces) through the
+    characteristics registry, and parses any values not yet typed at scrape time (older snapshots).
 
     Parameters
     ----------
     df: pd.DataFrame
         DF containing entire raw dataset.
+    schema: Optional[CharacteristicsSchema]
+        Characteristics registry, the one in 'characteristics_schema.json' if not provided.
+        Pass the same schema to format_feature_data.
+    profiler: Optional[StageProfiler]
+        If provided, records timings, memory and shapes for this stage and its sub-steps.
+    verbose: bool
+        Whether to print progress information.
 
     Returns
     -------
@@ -84,42 +111,48 @@ def label_based_cleaning(df: pd.DataFrame) -> pd.DataFrame:
         Same DF with potentially fewer records and reformatted column names and label data.
     """
 
-    og_shape = df.shape
-    print(f"Input data shape: {og_shape}")
-    print("Cleaning data by removing invalid records.")
-
-    #-----# 1. Quality of life changes #-----#
-    
-    # make columns lowercase and replace spaces with underscores
-    # also remove the "(s)" at the end of one of them, it's annoying
-    df.columns = (df.columns
-                  .str.replace(' ', '_')
-                  .str.lower()
-                  .str.replace('(s)', ''))
-
-    #-----# 2. Invalid label filtering and label formatting #-----#
-    
-    # convert sale_price to numerical value
-    df['sale_price'] = df['sale_price'].str.replace(r"[€,]", '', regex=True).astype(float)
-
-    # remove records with Null sale_price or with sale_price < SALE_PRICE_CUTOFF (140k)
-    sale_price_mask = (df['sale_price'].isna() == False) & (df['sale_price'] >= SALE_PRICE_CUTOFF)
-    n_removed = og_shape[0] - sale_price_mask.sum()
-    print(f"Removing records where label ('sale_price') is Null or lower than {SALE_PRICE_CUTOFF}:    {n_removed} records removed.")
-    df = df[sale_price_mask]
-
-    #-----# 3. Invalid record filtering #-----#
-
-    # remove invalid records which pertain to properties outside of luxembourg
-    invalid_locality_mask = df['locality'].isin(INVALID_LOCALITIES)
-    bad_rows_df = df[invalid_locality_mask]
-    print(f"Removing records from locations outside of Luxembourg:    {invalid_locality_mask.sum()} records removed.")
-    df = df.drop(bad_rows_df.index) 
-
-    print(f"Cleaned data shape: {df.shape}")
+    profiler = profiler or NULL_PROFILER
+    schema = schema if schema is not None else _default_schema()
+    with profiler.stage('label_based_cleaning', df) as stage:
+        og_shape = df.shape
+        _log(f"Input data shape: {og_shape}", verbose)
+        _log("Cleaning data by removing invalid records.", verbose)
+
+        #-----# 1. Quality of life changes #-----#
+        
+        # canonical names and typed values straight from the registry
+        with profiler.stage('schema parsing', df) as step:
+            df = schema.parse_frame(df)
+            step.output(df)
+
+        #-----# 2. Invalid label filtering and label formatting #-----#
+        
+        with profiler.stage('sale_price filtering', df) as step:
+            # remove records with Null sale_price or with sale_price < SALE_PRICE_CUTOFF (140k)
+            sale_price_mask = (df['sale_price'].isna() == False) & (df['sale_price'] >= SALE_PRICE_CUTOFF)
+            n_removed = og_shape[0] - sale_price_mask.sum()
+            _log(f"Removing records where label ('sale_price') is Null or lower than {SALE_PRICE_CUTOFF}:    {n_removed} records removed.", verbose)
+            df = df[sale_price_mask]
+            step.output(df)
+
+        #-----# 3. Invalid record filtering #-----#
+
+        with profiler.stage('invalid locality filtering', df) as step:
+            # remove invalid records which pertain to properties outside of luxembourg
+            invalid_locality_mask = df['locality'].isin(INVALID_LOCALITIES)
+            bad_rows_df = df[invalid_locality_mask]
+            _log(f"Removing records from locations outside of Luxembourg:    {invalid_locality_mask.sum()} records removed.", verbose)
+            df = df.drop(bad_rows_df.index) 
+            step.output(df)
+
+        _log(f"Cleaned data shape: {df.shape}", verbose)
+        stage.output(df)
     return df #.reset_index(drop=True) ###############################
 
-def format_feature_data(df: pd.DataFrame) -> pd.DataFrame:
+def format_feature_data(df: pd.DataFrame, 
+                        schema: Optional[CharacteristicsSchema] = None, 
+                        profiler: Optional[StageProfiler] = None, 
+                        verbose: bool = True) -> pd.DataFrame:
     """
     Data cleaning process. Takes care of formatting and harmonising the raw feature data collected by the scraper.
     Remaps Null values as appropriate depending on the specific type of data contained in the feature,
@@ -131,6 +164,14 @@ def format_feature_data(df: pd.DataFrame) -> pd.DataFrame:
     ----------
     df: pd.DataFrame
         DF containing raw feature data as extracted by the scraper module.
+    schema: Optional[CharacteristicsSchema]
+        Characteristics registry the data was typed with in label_based_cleaning, the one in
+        'characteristics_schema.json' if not provided. Column types are taken from it instead of
+        being detected by scanning every value.
+    profiler: Optional[StageProfiler]
+        If provided, records timings, memory and shapes for this stage and its sub-steps.
+    verbose: bool
+        Whether to print progress information.
     
     Returns
     -------
@@ -139,96 +180,87 @@ def format_feature_data(df: pd.DataFrame) -> pd.DataFrame:
 
     """
     
-    og_shape = df.shape
-    print(f"Formatting feature data. Input shape: {og_shape}")
-
-    #-----# 1. Generate new "missing data" indicator features #-----#
-
-    # create flag columns for those that contain nulls
-    # {feature}_missingflag columns will indicate whether the original {feature} value was missing for a given record record
-    print("Generating new '{feature}_missingflag' columns to flag missing data in a given record:")
-    for colname, colseries in df.items():
-        if colseries.isna().sum():
-            df[f"{colname}_missingflag"] = colseries.isna().astype(int)
-    print(f"\t {df.shape[1] - og_shape[1]} new columns generated.")
-
-    #-----# 2. Categorical Features: Reformat/clean/harmonise values #-----#
-
-    # remove "Luxembourg-" prefix from localities
-    df.locality = df.locality.str.replace("Luxembourg-", "")
-    # make location in brackets main location: some locations specified as "small town (commune)"
-    # split according to '(', take last string except last character ')'
-    main_locality_replace = lambda x: x.split('(')[-1][:-1] if '(' in x else x
-    df.locality = df.locality.apply(main_locality_replace)
-    # finally, reduce cardinality of 'locality' feature to most common locations
-    df.locality = df.locality.apply(lambda x: x if x in MAIN_LOCALITIES else 'other')
-
-    # keep only the letter grading on the energy and thermal insulation classes (some specified as "196.1E", keep only "E")
-    # if the string contains more than 1 character after keeping only letters it means it's "blank" or some other word to be replaced with NaN
-    classcols = [col for col in df.columns if ('class' in col) and ('_missingflag' not in col)]
-    for colname in classcols:
-        df[colname] = df[colname].str.replace('[^a-zA-Z]', '', regex=True)
-        df[colname] = df[colname].apply(lambda x: np.nan if len(str(x)) > 1 else x)
-        # add newly assigned NaNs to corresponding _missingflag column as missing
-        df.loc[df[colname].isna(), f"{colname}_missingflag"] = 1
-        # assign 'Z' to missing values so they'll be ordered last in the categories
-        df[colname] = df[colname].fillna('Z')
-
-    # yes/no columns (yes/NaN actually but whatever): reformat into binary flag columns (1=yes, 0=no)
-    yesnocols = [col for col in df.columns if (df[col] == 'Yes').sum()]
-    for colname in yesnocols:
-        # sometimes the 'garden' or 'terrace' features are filled with 'yes' instead of a surface value
-        if any(df[colname].str.find('m²') > -1):
-            yesnocols.remove(colname)
-        else:
-            df[colname] = (df[colname].str.lower() == 'yes').astype(float)
-
-    
-    #-----# 3. Numerical Features: dtype conversion/formatting #-----#
-
-    # columns denoting areas (m^2, ares) need to be translated from string into numerical value
-    # find all names of columns that contain 'm²' or 'ares'
-    m2_cols = []
-    ares_cols = []
-    for colname, colseries in df.items():
-        if not pd.api.types.is_numeric_dtype(colseries):
-            if any(colseries.str.find('m²') > -1):
-                m2_cols.append(colname)
-            elif any(colseries.str.find('ares') > -1):
-                ares_cols.append(colname)
-
-    # additional complication: garden and terrace columns sometimes filled with "yes" instead of surface value
-    for col in m2_cols:
-        # First fill nulls with "0" to prevent later imputation
-        df[col] = df[col].fillna('0')
-        # replace Yes with NaN so it gets filled in later with the median
-        df[col] = df[col].str.lower().replace('yes', np.nan)
-        # remove units and turn into float
-        df[col] = df[col].str.replace(r' m²|m|,', '', regex=True).astype(float)
-
-    # simpler with ares
-    for col in ares_cols:
-        # First fill nulls with "0" to prevent later imputation
-        df[col] = df[col].fillna('0')
-        # remove units and commas and turn into float
-        df[col] = df[col].str.replace(r' ares|,', '', regex=True).astype(float)
-
-    # for garage and propert'y_floor, fill Nulls with 0 also, seems logical that an empty value means it is not applicable
-    for col in ["garage", "property's_floor"]:
-        df[col] = df[col].fillna(0)
-
-    # add 2000 to the moron who put his construction year as just "12"
-    df['year_of_construction'] = df['year_of_construction'].apply(lambda x: x+2000 if x < 1000 else x)
-    # create new column for age_since_construction which is a more meaningful way of expressing it, then drop original
-    print("Converting column 'year_of_construction' into 'age_since_construction'.")
-    df['age_since_construction'] = datetime.datetime.today().year - df['year_of_construction']
-    df = df.drop('year_of_construction', axis=1)
-    
-    print(f"Formatted feature data shape: {df.shape}")
+    profiler = profiler or NULL_PROFILER
+    schema = schema if schema is not None else _default_schema()
+    with profiler.stage('format_feature_data', df) as stage:
+        og_shape = df.shape
+        _log(f"Formatting feature data. Input shape: {og_shape}", verbose)
+
+        # numerical registry columns still holding strings were never parsed, formatting them would silently corrupt them
+        numerical_types = ['numeric', 'price', 'yesno', 'area_m2', 'area_ares']
+        unparsed = [col for column_type in numerical_types for col in schema.columns_of_type(column_type)
+                    if (col in df.columns) and (df[col].dtype == object)]
+        if unparsed:
+            raise Exception(f'Columns {unparsed} have not been parsed into typed values, run label_based_cleaning with the same schema first.')
+
+        #-----# 1. Generate new "missing data" indicator features #-----#
+
+        with profiler.stage('missing flag generation', df) as step:
+            # create flag columns for those that contain nulls
+            # {feature}_missingflag columns will indicate whether the original {feature} value was missing for a given record record
+            _log("Generating new '{feature}_missingflag' columns to flag missing data in a given record:", verbose)
+            for colname, colseries in df.items():
+                if colseries.isna().sum():
+                    df[f"{colname}_missingflag"] = colseries.isna().astype(int)
+            _log(f"\t {df.shape[1] - og_shape[1]} new columns generated.", verbose)
+            step.output(df)
+
+        #-----# 2. Categorical Features: Reformat/clean/harmonise values #-----#
+
+        with profiler.stage('locality normalization', df) as step:
+            # remove "Luxembourg-" prefix from localities
+            df.locality = df.locality.str.replace("Luxembourg-", "")
+            # make location in brackets main location: some locations specified as "small town (commune)"
+            # split according to '(', take last string except last character ')'
+            main_locality_replace = lambda x: x.split('(')[-1][:-1] if '(' in x else x
+            df.locality = df.locality.apply(main_locality_replace)
+            # finally, reduce cardinality of 'locality' feature to most common locations
+            df.locality = df.locality.apply(lambda x: x if x in MAIN_LOCALITIES else 'other')
+            step.output(df)
+
+        with profiler.stage('class column cleanup', df) as step:
+            # energy and thermal insulation classes were reduced to their letter grading (or NaN, flagged above) when parsed
+            # assign 'Z' to missing values so they'll be ordered last in the categories
+            for colname in [col for col in schema.columns_of_type('class') if col in df.columns]:
+                df[colname] = df[colname].fillna('Z')
+            step.output(df)
+
+        with profiler.stage('yes/no column cleanup', df) as step:
+            # yes/no columns were parsed into 1.0 (yes) / NaN (missing), missing means no
+            for colname in [col for col in schema.columns_of_type('yesno') if col in df.columns]:
+                df[colname] = df[colname].fillna(0.)
+            step.output(df)
+
+        
+        #-----# 3. Numerical Features: dtype conversion/formatting #-----#
+
+        with profiler.stage('m²/ares parsing', df) as step:
+            # areas (m², ares) were parsed into floats: fill nulls with 0 to prevent later imputation (no garden/terrace),
+            # and replace AREA_UNSPECIFIED (garden and terrace sometimes filled with "yes") with NaN so it gets imputed later
+            area_cols = schema.columns_of_type('area_m2') + schema.columns_of_type('area_ares')
+            for col in [col for col in area_cols if col in df.columns]:
+                df[col] = df[col].fillna(0.).replace(AREA_UNSPECIFIED, np.nan)
+            step.output(df)
+
+        # for garage and propert'y_floor, fill Nulls with 0 also, seems logical that an empty value means it is not applicable
+        for col in ["garage", "property's_floor"]:
+            df[col] = df[col].fillna(0)
+
+        # add 2000 to the moron who put his construction year as just "12"
+        df['year_of_construction'] = df['year_of_construction'].apply(lambda x: x+2000 if x < 1000 else x)
+        # create new column for age_since_construction which is a more meaningful way of expressing it, then drop original
+        _log("Converting column 'year_of_construction' into 'age_since_construction'.", verbose)
+        df['age_since_construction'] = datetime.datetime.today().year - df['year_of_construction']
+        df = df.drop('year_of_construction', axis=1)
+        
+        _log(f"Formatted feature data shape: {df.shape}", verbose)
+        stage.output(df)
     return df
 
 
-def encode_categoricals(df: pd.DataFrame, encoders: dict[str, object]) -> pd.DataFrame:
+def encode_categoricals(df: pd.DataFrame, 
+                        encoders: dict[str, object], 
+                        profiler: Optional[StageProfiler] = None) -> pd.DataFrame:
     """
     Encodes categorical variables using 2 different strategies, both of which must be provided
     in the input 'encoders' dictionary.
@@ -242,6 +274,8 @@ def encode_categoricals(df: pd.DataFrame, encoders: dict[str, object]) -> pd.Dat
     encoders: dict[str, object]
         Dictionary containing the encoders pre-fitted to the training set, ready to perform
         encoder.transform(X) operations. 
+    profiler: Optional[StageProfiler]
+        If provided, records timings, memory and shapes for this stage.
 
     Returns
     -------
@@ -250,22 +284,28 @@ def encode_categoricals(df: pd.DataFrame, encoders: dict[str, object]) -> pd.Dat
     
     """
 
-    # unpack encoder dict
-    ordinal_encoder = encoders['ordinal_encoder']
-    ordinal_columns = list(ordinal_encoder.feature_names_in_)
-    onehot_encoder = encoders['onehot_encoder']
-    onehot_columns = list(onehot_encoder.feature_names_in_)
+    profiler = profiler or NULL_PROFILER
+    with profiler.stage('encode_categoricals', df) as stage:
+        # unpack encoder dict
+        ordinal_encoder = encoders['ordinal_encoder']
+        ordinal_columns = list(ordinal_encoder.feature_names_in_)
+        onehot_encoder = encoders['onehot_encoder']
+        onehot_columns = list(onehot_encoder.feature_names_in_)
 
-    # apply transformations
-    df[ordinal_columns] = ordinal_encoder.transform(df[ordinal_columns])
+        # apply transformations
+        df[ordinal_columns] = ordinal_encoder.transform(df[ordinal_columns])
 
-    onehot_array = onehot_encoder.transform(df[onehot_columns])
-    onehot_df = pd.DataFrame(onehot_array, columns=onehot_encoder.get_feature_names_out(onehot_columns), index=df.index)
-    df = pd.concat([df.drop(onehot_columns, axis=1), onehot_df], axis=1)
+        onehot_array = onehot_encoder.transform(df[onehot_columns])
+        onehot_df = pd.DataFrame(onehot_array, columns=onehot_encoder.get_feature_names_out(onehot_columns), index=df.index)
+        df = pd.concat([df.drop(onehot_columns, axis=1), onehot_df], axis=1)
+        stage.output(df)
 
     return df
 
-def impute_numericals(df: pd.DataFrame, impute_map: dict[str, pd.Series]) -> pd.DataFrame:
+def impute_numericals(df: pd.DataFrame, 
+                      impute_map: dict[str, pd.Series], 
+                      columns: Optional[list[str]] = None, 
+                      profiler: Optional[StageProfiler] = None) -> pd.DataFrame:
     """
     Fills Null values in input DataFrame with group-specific values for all numerical features.
     E.g., replaces Nulls in, say, the 'terrace' column with different values depending on whether
@@ -278,19 +318,32 @@ def impute_numericals(df: pd.DataFrame, impute_map: dict[str, pd.Series]) -> pd.
     impute_map: dict[str, pd.Series]
         Dictionary where the Keys are numerical feature names and the values are pd.Series 
         which map the different property_types (as indices) to the imputation value for each
-        type.
+        type. Property types missing from a Series are filled with the median of its values.
+    columns: Optional[list[str]]
+        Columns to impute. By default all numerical non-flag columns (more than 2 distinct values) are
+        imputed, which is only reliable on the full training set: pass e.g. list(impute_map) when
+        processing small batches of data, where a column may happen to have few distinct values.
+    profiler: Optional[StageProfiler]
+        If provided, records timings, memory and shapes for this stage.
 
     Returns
     -------
     pd.DataFrame
     """
 
-    grouped = df.groupby('property_type', group_keys=False) # group_keys=False is important for the .apply to work correctly
-    # loop through columns
-    for colname in df.columns:
-        # filter only numerical non-flag columns
-        if pd.api.types.is_numeric_dtype(df[colname]) and (df[colname].nunique(dropna=False) > 2):
+    profiler = profiler or NULL_PROFILER
+    with profiler.stage('impute_numericals', df) as stage:
+        grouped = df.groupby('property_type', group_keys=False) # group_keys=False is important for the .apply to work correctly
+        if columns is None:
+            # filter only numerical non-flag columns
+            columns = [colname for colname in df.columns
+                       if pd.api.types.is_numeric_dtype(df[colname]) and (df[colname].nunique(dropna=False) > 2)]
+        # loop through columns
+        for colname in columns:
             # fill Nulls in each feature with group-specific values (e.g., median of the group)
-            df[colname] = grouped[colname].apply(lambda group: group.fillna(impute_map[colname][group.name]))
+            # property types not seen when fitting the map fall back to the median across all types
+            fill_values = impute_map[colname]
+            df[colname] = grouped[colname].apply(lambda group: group.fillna(fill_values.get(group.name, fill_values.median())))
+        stage.output(df)
 
     return df
@@ -0,0 +1,105 @@
+### Lightweight inference runtime for models exported with model_export.py.
+### Deliberately does not import TensorFlow so scoring jobs start fast.
+import os
+import threading
+from typing import Optional
+import numpy as np
+
+# activations used by the layers of model_pipeline._create_model
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+}
+
+
+def scaler_sidecar_path(path: str) -> str:
+    """Path of the input scaling parameters stored next to a .tflite model (int8 exports only)."""
+    return path + '.scaler.npz'
+
+def _scale_inputs(X: np.ndarray, input_mean: Optional[np.ndarray], input_scale: Optional[np.ndarray]) -> np.ndarray:
+    """Standardises X with the stored scaler parameters, if the export kept the scaler separate."""
+    X = np.asarray(X, dtype=np.float32)
+    if input_mean is None:
+        return X
+    return (X - input_mean) / input_scale
+
+
+class NumpyMLP:
+    """
+    Runs a stack of Dense layers exported with model_export.export_numpy() using plain numpy.
+    Weights stored as float16 or int8 are dequantized to float32 once at load time.
+    int8 exports store the scaler parameters instead of folding them into the weights, they are applied to the inputs.
+    Thread-safe, so it can be used with batch_scoring's threaded predictions.
+    """
+
+    def __init__(self, path: str) -> None:
+        with np.load(path) as npz:
+            n_layers = int(npz['n_layers'])
+            self.activations = [str(x) for x in npz['activations']]
+            self.input_mean = npz['input_mean'] if 'input_mean' in npz else None
+            self.input_scale = npz['input_scale'] if 'input_scale' in npz else None
+            self.weights = []
+            self.biases = []
+            for i in range(n_layers):
+                kernel = npz[f'kernel_{i}'].astype(np.float32)
+                # int8 kernels are stored with one scale per output unit
+                if f'scale_{i}' in npz:
+                    kernel *= npz[f'scale_{i}']
+                self.weights.append(kernel)
+                self.biases.append(npz[f'bias_{i}'].astype(np.float32))
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        h = _scale_inputs(X, self.input_mean, self.input_scale)
+        for kernel, bias, activation in zip(self.weights, self.biases, self.activations):
+            h = ACTIVATIONS[activation](h @ kernel + bias)
+        return h
+
+
+class TFLiteModel:
+    """
+    Runs a .tflite model exported with model_export.export_tflite() through the standalone LiteRT / tflite_runtime
+    interpreter. The interpreter is not thread-safe, so concurrent predict() calls are serialised and
+    parallelism comes from the interpreter's own threads instead.
+    If scaler parameters were stored next to the model (int8 exports), they are applied to the inputs.
+    """
+
+    def __init__(self, path: str, num_threads: Optional[int] = None) -> None:
+        try:
+            from ai_edge_litert.interpreter import Interpreter
+        except ImportError:
+            try:
+                from tflite_runtime.interpreter import Interpreter
+            except ImportError:
+                raise ImportError('Running .tflite models requires ai-edge-litert or tflite-runtime: pip install ai-edge-litert')
+
+        self.interpreter = Interpreter(model_path=path, num_threads=num_threads or os.cpu_count())
+        self.input_mean, self.input_scale = None, None
+        if os.path.exists(scaler_sidecar_path(path)):
+            with np.load(scaler_sidecar_path(path)) as npz:
+                self.input_mean, self.input_scale = npz['input_mean'], npz['input_scale']
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self._batch_size = None
+        self._lock = threading.Lock()
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        X = _scale_inputs(X, self.input_mean, self.input_scale)
+        with self._lock:
+            # reallocating is costly, only do it when the batch size changes
+            if X.shape[0] != self._batch_size:
+                self.interpreter.resize_tensor_input(self.input_index, X.shape)
+                self.interpreter.allocate_tensors()
+                self._batch_size = X.shape[0]
+            self.interpreter.set_tensor(self.input_index, X)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output_index).copy()
+
+
+def load_lite_model(path: str, num_threads: Optional[int] = None) -> NumpyMLP | TFLiteModel:
+    """Loads an exported model (.npz or .tflite) for inference without TensorFlow."""
+
+    if path.endswith('.npz'):
+        return NumpyMLP(path)
+    if path.endswith('.tflite'):
+        return TFLiteModel(path, num_threads)
+    raise Exception(f'Unsupported model format ({path}), expected a .npz or .tflite file.')
@@ -0,0 +1,244 @@
+import os
+import time
+from typing import Optional
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from sklearn.preprocessing import StandardScaler
+
+from lite_runtime import load_lite_model, scaler_sidecar_path, ACTIVATIONS
+from utils import _grouped_metrics
+
+## constants
+QUANTIZATION_MODES = [None, 'float16', 'int8']
+# number of training rows used to calibrate the int8 activation ranges
+REPRESENTATIVE_SAMPLES = 500
+
+
+def _fold_scaler(kernel: np.ndarray, bias: np.ndarray, scaler: StandardScaler) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Folds a fitted StandardScaler into the weights of the first Dense layer, so the exported model takes
+    unscaled features: W @ ((x - mean) / scale) + b == (W / scale) @ x + (b - W @ (mean / scale)).
+    """
+
+    mean = scaler.mean_ if scaler.mean_ is not None else np.zeros(kernel.shape[0])
+    scale = scaler.scale_ if scaler.scale_ is not None else np.ones(kernel.shape[0])
+    folded_kernel = kernel / scale[:, np.newaxis]
+    folded_bias = bias - (mean / scale) @ kernel
+
+    return folded_kernel.astype(kernel.dtype), folded_bias.astype(bias.dtype)
+
+def _scaler_arrays(scaler: StandardScaler, n_features: int) -> dict[str, np.ndarray]:
+    """Mean and scale of a fitted StandardScaler, for exports which apply it to the inputs instead of folding it."""
+
+    mean = scaler.mean_ if scaler.mean_ is not None else np.zeros(n_features)
+    scale = scaler.scale_ if scaler.scale_ is not None else np.ones(n_features)
+    return {'input_mean': mean.astype(np.float32), 'input_scale': scale.astype(np.float32)}
+
+def export_tflite(model: tf.keras.Model,
+                  path: str,
+                  quantization: Optional[str] = None,
+                  representative_data: Optional[np.ndarray] = None,
+                  scaler: Optional[StandardScaler] = None) -> str:
+    """
+    Converts a trained Keras model into a TFLite flatbuffer, optionally quantized.
+
+    Parameters
+    ----------
+    model: tf.keras.Model
+        Trained model, e.g. as returned by model_pipeline.bingobango().
+    path: str
+        Output filepath, should end in '.tflite'.
+    quantization: Optional[str]
+        None (float32), 'float16' (float16 weights) or 'int8' (full integer kernels, float32 inputs/outputs).
+    representative_data: Optional[np.ndarray]
+        Unscaled training features, required to calibrate 'int8' quantization.
+    scaler: Optional[StandardScaler]
+        Scaler the model was trained behind, so the exported model takes unscaled features.
+        For float32/float16 it is folded into the first Dense layer. For int8 it is saved next to the
+        model (see lite_runtime.scaler_sidecar_path) and applied to the inputs at inference time, since
+        folding it would leave features with very different ranges sharing a single input quantization scale.
+
+    Returns
+    -------
+    str
+        Path of the written file.
+    """
+
+    if quantization not in QUANTIZATION_MODES:
+        raise Exception(f'Unknown quantization ({quantization}), expected one of {QUANTIZATION_MODES}.')
+
+    sidecar_path = scaler_sidecar_path(path)
+    # don't leave parameters of a previous export next to this one
+    if os.path.exists(sidecar_path):
+        os.remove(sidecar_path)
+
+    if (scaler is not None) and (quantization == 'int8'):
+        np.savez(sidecar_path, **_scaler_arrays(scaler, model.input_shape[-1]))
+        # the quantized model receives scaled inputs, so calibrate it on those
+        if representative_data is not None:
+            representative_data = scaler.transform(representative_data)
+    elif scaler is not None:
+        # fold into a copy so the original model is left untouched
+        folded_model = tf.keras.models.clone_model(model)
+        folded_model.set_weights(model.get_weights())
+        first_dense = next(layer for layer in folded_model.layers if isinstance(layer, tf.keras.layers.Dense))
+        first_dense.set_weights(list(_fold_scaler(*first_dense.get_weights(), scaler)))
+        model = folded_model
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        if representative_data is None:
+            raise Exception('int8 quantization requires representative_data to calibrate activation ranges.')
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([row[np.newaxis].astype(np.float32)]
+                                                    for row in representative_data[:REPRESENTATIVE_SAMPLES])
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    with open(path, 'wb') as f:
+        f.write(converter.convert())
+
+    return path
+
+def export_numpy(model: tf.keras.Model, 
+                 path: str, 
+                 quantization: Optional[str] = None, 
+                 scaler: Optional[StandardScaler] = None) -> str:
+    """
+    Exports the Dense layers of a trained Keras MLP to a .npz file runnable with lite_runtime.NumpyMLP.
+    Dropout layers are skipped since they are inactive at inference time.
+
+    Parameters
+    ----------
+    model: tf.keras.Model
+        Trained model made up only of Dense and Dropout layers (see model_pipeline._create_model).
+    path: str
+        Output filepath, should end in '.npz'.
+    quantization: Optional[str]
+        None (float32 weights), 'float16' (float16 weights) or 'int8' (symmetric per-unit int8 kernels).
+        Quantization only shrinks the file, computations are done in float32.
+    scaler: Optional[StandardScaler]
+        Scaler the model was trained behind, so the exported model takes unscaled features.
+        For float32/float16 it is folded into the first Dense layer. For int8 it is stored in the file and
+        applied to the inputs, since folding it would make the kernel ranges depend on the feature ranges
+        and the int8 scale set by the largest weights would round those of wide-range features to 0.
+
+    Returns
+    -------
+    str
+        Path of the written file.
+    """
+
+    if quantization not in QUANTIZATION_MODES:
+        raise Exception(f'Unknown quantization ({quantization}), expected one of {QUANTIZATION_MODES}.')
+
+    fold_scaler = (scaler is not None) and (quantization != 'int8')
+    arrays = {}
+    if (scaler is not None) and not fold_scaler:
+        arrays.update(_scaler_arrays(scaler, model.input_shape[-1]))
+    activations = []
+    for layer in model.layers:
+        if isinstance(layer, tf.keras.layers.Dropout):
+            continue
+        if not isinstance(layer, tf.keras.layers.Dense):
+            raise Exception(f'Cannot export layer {layer.name} of type {type(layer).__name__}, only Dense layers are supported.')
+        activation = layer.get_config()['activation']
+        if activation not in ACTIVATIONS:
+            raise Exception(f'Cannot export activation {activation} of layer {layer.name}.')
+
+        i = len(activations)
+        kernel, bias = layer.get_weights()
+        if (i == 0) and fold_scaler:
+            kernel, bias = _fold_scaler(kernel, bias, scaler)
+        if quantization == 'int8':
+            # one scale per output unit, zero point at 0
+            scale = np.abs(kernel).max(axis=0) / 127
+            scale[scale == 0] = 1
+            arrays[f'kernel_{i}'] = np.round(kernel / scale).astype(np.int8)
+            arrays[f'scale_{i}'] = scale.astype(np.float32)
+        elif quantization == 'float16':
+            arrays[f'kernel_{i}'] = kernel.astype(np.float16)
+        else:
+            arrays[f'kernel_{i}'] = kernel.astype(np.float32)
+        arrays[f'bias_{i}'] = bias.astype(np.float32)
+        activations.append(activation)
+
+    np.savez(path, n_layers=len(activations), activations=np.array(activations), **arrays)
+
+    return path
+
+def compare_exports(model: tf.keras.Model,
+                    X: np.ndarray,
+                    y: np.ndarray,
+                    export_paths: list[str],
+                    n_repeats: int = 10,
+                    scaler: Optional[StandardScaler] = None) -> pd.DataFrame:
+    """
+    Compares accuracy and latency of exported models against the original Keras model on the same data.
+
+    Parameters
+    ----------
+    model: tf.keras.Model
+        Original trained model.
+    X: np.ndarray
+        Features as the exported models receive them, i.e. unscaled if they were exported with a scaler.
+    y: np.ndarray
+        Labels corresponding to X.
+    export_paths: list[str]
+        Paths of the exported models (.npz or .tflite).
+    n_repeats: int
+        Number of full passes over X used to time predictions.
+    scaler: Optional[StandardScaler]
+        Scaler the exports were made with, applied to X before passing it to the original model.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per model with its file size, load time, prediction throughput, MAE/RMSLE/R^2
+        and the largest absolute difference from the original model's predictions.
+    """
+
+    X = np.asarray(X, dtype=np.float32)
+    y = np.asarray(y, dtype=float)
+    single_group = np.zeros(len(y), dtype=int)
+
+    def _time_predictions(predict) -> tuple[np.ndarray, float]:
+        preds = np.asarray(predict(X)).ravel()
+        st_time = time.perf_counter()
+        for _ in range(n_repeats):
+            predict(X)
+        rows_per_s = n_repeats * len(X) / (time.perf_counter() - st_time)
+        return preds, rows_per_s
+
+    if scaler is not None:
+        # the original model still expects scaled features, so the scaling is part of its timing
+        original_predict = lambda X: model.predict(scaler.transform(X), batch_size=len(X), verbose=0)
+    else:
+        original_predict = lambda X: model.predict(X, batch_size=len(X), verbose=0)
+    original_preds, original_rows_per_s = _time_predictions(original_predict)
+    candidates = [('keras', None, None, original_preds, original_rows_per_s)]
+    for path in export_paths:
+        st_time = time.perf_counter()
+        lite_model = load_lite_model(path)
+        load_time = time.perf_counter() - st_time
+        preds, rows_per_s = _time_predictions(lite_model.predict)
+        candidates.append((os.path.basename(path), os.path.getsize(path), load_time, preds, rows_per_s))
+
+    rows = []
+    for name, size, load_time, preds, rows_per_s in candidates:
+        metrics = _grouped_metrics(y, preds.astype(float), single_group, 1)
+        rows.append({
+            'model': name,
+            'file_size_MB': None if size is None else round(size / 2**20, 4),
+            'load_time_s': load_time,
+            'rows/s': rows_per_s,
+            'MAE': metrics['MAE'][0],
+            'RMSLE': metrics['RMSLE'][0],
+            'R^2': metrics['R^2'][0],
+            'max_abs_diff': np.abs(preds - original_preds).max(),
+        })
+
+    return pd.DataFrame(rows)
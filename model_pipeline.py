@@ -9,6 +9,7 @@ from typing import Tuple, Optional
 from datetime import datetime
 
 from utils import _setup_directory, _find_file
+from model_export import export_tflite, export_numpy, QUANTIZATION_MODES
 
 
 class Dataset:
@@ -16,12 +17,14 @@ class Dataset:
     X_test: np.ndarray
     y_train: np.ndarray
     y_test: np.ndarray
+    scaler: Optional[StandardScaler]
 
-    def __init__(self, X_train, X_test, y_train, y_test) -> None:
+    def __init__(self, X_train, X_test, y_train, y_test, scaler=None) -> None:
         self.X_train = X_train
         self.X_test = X_test
         self.y_train = y_train
         self.y_test = y_test
+        self.scaler = scaler
 
     def components(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
         return self.X_train, self.X_test, self.y_train, self.y_test
@@ -62,7 +65,7 @@ def _preprocessing(df: pd.DataFrame) -> Dataset:
     X_train_scaled = scaler.fit_transform(X_train)
     X_test_scaled = scaler.transform(X_test)
 
-    data = Dataset(X_train_scaled, X_test_scaled, y_train, y_test)
+    data = Dataset(X_train_scaled, X_test_scaled, y_train, y_test, scaler)
 
     return data
 
@@ -80,7 +83,13 @@ def _create_model(num_features) -> tf.keras.models.Sequential:
     return model
 
 
-def bingobango(file: Optional[str] = None) -> Tuple[tf.keras.Sequential, tf.keras.callbacks.History]:
+def bingobango(file: Optional[str] = None, 
+               export: bool = False, 
+               export_quantization: Optional[str] = None) -> Tuple[tf.keras.Sequential, tf.keras.callbacks.History]:
+
+    # check export settings before spending time on training
+    if export_quantization not in QUANTIZATION_MODES:
+        raise Exception(f'Unknown quantization ({export_quantization}), expected one of {QUANTIZATION_MODES}.')
 
     # quick setup
     _setup_directory()
@@ -92,7 +101,8 @@ def bingobango(file: Optional[str] = None) -> Tuple[tf.keras.Sequential, tf.kera
     df = pd.read_csv(target_filepath)
 
     # preprocess data into a dataset
-    X_train, X_test, y_train, y_test = _preprocessing(df).components()
+    data = _preprocessing(df)
+    X_train, X_test, y_train, y_test = data.components()
 
     # create model with appropriate input layer size
     model = _create_model(X_train.shape[-1])
@@ -110,6 +120,14 @@ def bingobango(file: Optional[str] = None) -> Tuple[tf.keras.Sequential, tf.kera
 
     model_path = os.path.dirname(os.path.abspath(__file__)) + f'/models/model_{target_timestamp}'
     model.save(model_path)
+
+    # optionally also export a lightweight version for fast cold starts (see lite_runtime.py)
+    # the scaler is part of the exports (folded in, or stored alongside for int8), so they take unscaled features
+    if export:
+        export_suffix = export_quantization or 'float32'
+        X_train_unscaled = data.scaler.inverse_transform(X_train)
+        export_tflite(model, model_path + f'_{export_suffix}.tflite', export_quantization, X_train_unscaled, data.scaler)
+        export_numpy(model, model_path + f'_{export_suffix}.npz', export_quantization, data.scaler)
     
     return model, hist
 
@@ -0,0 +1,148 @@
+import sys
+import time
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+from typing import Optional, Iterator
+import pandas as pd
+
+# 'resource' only exists on Unix, peak RSS is simply not reported elsewhere
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class StageRecord:
+    """Measurements for a single (sub-)stage of a run, filled in by StageProfiler.stage()."""
+
+    def __init__(self, name: str, depth: int, df: Optional[pd.DataFrame] = None) -> None:
+        self.name = name
+        self.depth = depth
+        self.rows_in, self.cols_in = df.shape if df is not None else (None, None)
+        self.rows_out, self.cols_out = None, None
+        self.wall_time = 0.
+        self.cpu_time = 0.
+        self.tracemalloc_peak = None
+        self.peak_rss = None
+
+    def output(self, df: pd.DataFrame) -> None:
+        """Records the shape of the DF produced by the stage."""
+        self.rows_out, self.cols_out = df.shape
+
+    def as_dict(self) -> dict[str, object]:
+        return {
+            'stage': '  ' * self.depth + self.name,
+            'wall_time_s': round(self.wall_time, 4),
+            'cpu_time_s': round(self.cpu_time, 4),
+            'tracemalloc_peak_MB': None if self.tracemalloc_peak is None else round(self.tracemalloc_peak / 2**20, 2),
+            'peak_rss_MB': None if self.peak_rss is None else round(self.peak_rss, 2),
+            'rows_in': self.rows_in,
+            'cols_in': self.cols_in,
+            'rows_out': self.rows_out,
+            'cols_out': self.cols_out,
+        }
+
+
+class StageProfiler:
+    """
+    Opt-in instrumentation for the preprocessing stages.
+    Each stage (and sub-step) wrapped in 'with profiler.stage(name, df) as rec:' records its wall time,
+    CPU time, tracemalloc peak (relative to the memory allocated when the stage started), the process'
+    peak RSS so far and the input/output row and column counts.
+    Stages can be nested, the report is indented accordingly.
+
+    Parameters
+    ----------
+    trace_memory: bool
+        Whether to track allocations with tracemalloc. Adds noticeable overhead to the run time.
+    cprofile: bool
+        Whether to also run cProfile over the outermost stages, see dump_stats().
+    """
+
+    def __init__(self, trace_memory: bool = True, cprofile: bool = False) -> None:
+        self.trace_memory = trace_memory
+        self.records: list[StageRecord] = []
+        self._profiler = cProfile.Profile() if cprofile else None
+        # [start_current, running_peak] for each currently open stage, needed to nest tracemalloc peaks
+        self._mem_stack: list[list[int]] = []
+        self._started_tracemalloc = False
+
+    @contextmanager
+    def stage(self, name: str, df: Optional[pd.DataFrame] = None) -> Iterator[StageRecord]:
+        record = StageRecord(name, len(self._mem_stack), df)
+        self.records.append(record)
+        outermost = not self._mem_stack
+
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+            current, peak = tracemalloc.get_traced_memory()
+            # save the parent's peak before resetting it for this stage
+            if self._mem_stack:
+                self._mem_stack[-1][1] = max(self._mem_stack[-1][1], peak)
+            tracemalloc.reset_peak()
+        else:
+            current = 0
+        self._mem_stack.append([current, current])
+
+        if outermost and self._profiler is not None:
+            self._profiler.enable()
+        st_wall, st_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record.wall_time = time.perf_counter() - st_wall
+            record.cpu_time = time.process_time() - st_cpu
+            if outermost and self._profiler is not None:
+                self._profiler.disable()
+
+            start_current, running_peak = self._mem_stack.pop()
+            if self.trace_memory:
+                running_peak = max(running_peak, tracemalloc.get_traced_memory()[1])
+                record.tracemalloc_peak = running_peak - start_current
+                # propagate this stage's peak to the parent
+                if self._mem_stack:
+                    self._mem_stack[-1][1] = max(self._mem_stack[-1][1], running_peak)
+                elif self._started_tracemalloc:
+                    tracemalloc.stop()
+                    self._started_tracemalloc = False
+            record.peak_rss = _peak_rss_mb()
+
+    def report(self) -> pd.DataFrame:
+        """Returns one row per recorded stage, in the order in which the stages were entered."""
+        return pd.DataFrame([record.as_dict() for record in self.records])
+
+    def print_report(self) -> None:
+        print(self.report().to_string(index=False))
+
+    def dump_stats(self, filepath: str) -> None:
+        """
+        Writes the cProfile stats (pstats format) to filepath. These can be inspected with the pstats
+        module or turned into a flamegraph with e.g. snakeviz, flameprof or gprof2dot.
+        """
+        if self._profiler is None:
+            raise Exception('cProfile was not enabled for this profiler, create it with cprofile=True.')
+        self._profiler.dump_stats(filepath)
+
+
+class _NullProfiler:
+    """Stand-in used when no profiler is passed, so stages can always be wrapped in 'with profiler.stage(...)'."""
+
+    @contextmanager
+    def stage(self, name: str, df: Optional[pd.DataFrame] = None) -> Iterator[StageRecord]:
+        yield StageRecord(name, 0)
+
+NULL_PROFILER = _NullProfiler()
+
+
+def _peak_rss_mb() -> Optional[float]:
+    """Peak resident set size of the process so far in MB, None if unavailable on this platform."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS but in kilobytes on Linux
+    if sys.platform == 'darwin':
+        return max_rss / 2**20
+    return max_rss / 1024
@@ -2,7 +2,6 @@ import os
 from typing import Optional, Tuple, Protocol
 import numpy as np
 import pandas as pd
-from sklearn.metrics import mean_absolute_error, root_mean_squared_log_error
 
 def _setup_directory() -> None:
     """Checks if required directories exist, creates them if not."""
@@ -12,8 +11,10 @@ def _setup_directory() -> None:
     raw_csv_dir = current_filepath + '/raw_datasets/'
     clean_csv_dir = current_filepath + '/clean_datasets/'
     models_dir = current_filepath + '/models/'
+    scored_dir = current_filepath + '/scored_datasets/'
+    cache_dir = current_filepath + '/cache/'
 
-    dirs = [url_dir, raw_csv_dir, clean_csv_dir, models_dir]
+    dirs = [url_dir, raw_csv_dir, clean_csv_dir, models_dir, scored_dir, cache_dir]
 
     # create directories if they do not exist
     for dir_ in dirs:
@@ -57,6 +58,64 @@ class ScikitModel(Protocol):
     def score(self, X, y, sample_weight=None): ...
     def get_params(self, **params): ...
 
+# price bands (in €) for the per-segment breakdown in evaluate_models
+PRICE_BANDS = [0, 500000, 750000, 1000000, 1500000, np.inf]
+# number of rows passed to model.predict() at once during evaluation
+EVAL_CHUNK_SIZE = 8192
+
+def _predict_chunked(model: ScikitModel, 
+                     X: pd.DataFrame | np.ndarray, 
+                     chunk_size: int = EVAL_CHUNK_SIZE) -> np.ndarray:
+    """Runs a single prediction pass over X in chunks of chunk_size rows, returns a flat array of predictions."""
+
+    preds = np.empty(len(X), dtype=float)
+    for start in range(0, len(X), chunk_size):
+        chunk = X.iloc[start:start+chunk_size] if isinstance(X, pd.DataFrame) else X[start:start+chunk_size]
+        # ravel since keras models return an (n, 1) array
+        preds[start:start+chunk_size] = np.asarray(model.predict(chunk)).ravel()
+
+    return preds
+
+def _group_indices(keys: pd.Series | np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns integer group codes for each record and the corresponding group labels."""
+
+    codes, labels = pd.factorize(pd.Series(keys).astype(str))
+    return codes, np.asarray(labels)
+
+def _price_band_indices(y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns integer price band codes (see PRICE_BANDS) for each record and the band labels."""
+
+    codes = np.digitize(y, PRICE_BANDS[1:-1])
+    labels = np.array([f"{low:,.0f}-{high:,.0f}" for low, high in zip(PRICE_BANDS[:-1], PRICE_BANDS[1:])])
+    return codes, labels
+
+def _grouped_metrics(y_true: np.ndarray, 
+                     y_pred: np.ndarray, 
+                     codes: np.ndarray, 
+                     n_groups: int) -> dict[str, np.ndarray]:
+    """
+    Computes count, MAE, RMSLE and R^2 for every group at once from a single set of predictions.
+    RMSLE is NaN for groups containing negative predictions, R^2 is NaN for groups with constant labels.
+    """
+
+    count = np.bincount(codes, minlength=n_groups)
+    errors = y_true - y_pred
+    abs_err = np.bincount(codes, weights=np.abs(errors), minlength=n_groups)
+    sq_err = np.bincount(codes, weights=errors**2, minlength=n_groups)
+    n_negative = np.bincount(codes, weights=(y_pred < 0), minlength=n_groups)
+    # clip so negative predictions don't produce NaNs, the affected groups are masked out below anyway
+    sq_log_err = np.bincount(codes, weights=(np.log1p(np.clip(y_pred, 0, None)) - np.log1p(y_true))**2, minlength=n_groups)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        group_means = np.bincount(codes, weights=y_true, minlength=n_groups) / count
+        sq_total = np.bincount(codes, weights=(y_true - group_means[codes])**2, minlength=n_groups)
+        return {
+            'n': count,
+            'MAE': abs_err / count,
+            'RMSLE': np.where(n_negative > 0, np.nan, np.sqrt(sq_log_err / count)),
+            'R^2': np.where(sq_total > 0, 1 - sq_err / sq_total, np.nan),
+        }
+
 # convenient evaluation function
 def evaluate_sk_model(model: ScikitModel, 
                    X_valid: pd.DataFrame, 
@@ -64,43 +123,140 @@ def evaluate_sk_model(model: ScikitModel,
                    X_train: Optional[pd.DataFrame] = None, 
                    y_train: Optional[pd.Series | np.ndarray] = None) -> dict[str, float]:
     """
-    Runs model.predict() and prints a few evaluation metrics (MAE, RMSLE, R^2 score).
+    Runs model.predict() once per set and prints a few evaluation metrics (MAE, RMSLE, R^2 score).
     """
     
     # dictionary to store results
     results = {}
 
-    # generate training set predictions if provided
-    if (X_train is not None) and (y_train is not None):
-        train_preds = model.predict(X=X_train)
-        print("Performance on Training Set:")
-        train_mae = mean_absolute_error(y_true=y_train, y_pred=train_preds)
-        results['Training MAE'] = train_mae
-        print(f"\tMAE: {train_mae}")
-        if len(train_preds[train_preds < 0]):
+    sets = [('Training', 'Training', X_train, y_train), ('Validation', 'Valid', X_valid, y_valid)]
+    for set_name, key_prefix, X, y in sets:
+        if (X is None) or (y is None):
+            continue
+        y = np.asarray(y, dtype=float)
+        preds = _predict_chunked(model, X)
+        metrics = _grouped_metrics(y, preds, np.zeros(len(y), dtype=int), 1)
+
+        print(f"Performance on {set_name} Set:")
+        results[f'{key_prefix} MAE'] = metrics['MAE'][0]
+        print(f"\tMAE: {metrics['MAE'][0]}")
+        if np.isnan(metrics['RMSLE'][0]):
             print("\tNo RMSLE: predictions contain negative numbers")
         else:
-            train_rmsle = root_mean_squared_log_error(y_true=y_train, y_pred=train_preds)
-            results['Training RMSLE'] = train_rmsle
-            print(f"\tRMSLE: {train_rmsle}")
-        train_r2 = model.score(X=X_train, y=y_train)
-        results['Training R^2'] = train_r2
-        print(f"\tR^2: {train_r2}")
-    
-    # generate validation predictions
-    valid_preds = model.predict(X=X_valid)
-    print("Performance on Validation Set:")
-    valid_mae = mean_absolute_error(y_true=y_valid, y_pred=valid_preds)
-    results['Valid MAE'] = valid_mae
-    print(f"\tMAE: {valid_mae}")
-    if len(valid_preds[valid_preds < 0]):
-        print("\tNo RMSLE: predictions containe negative numbers")
-    else:
-        valid_rmsle = root_mean_squared_log_error(y_true=y_valid, y_pred=valid_preds)
-        results['Valid RMSLE'] = valid_rmsle
-        print(f"\tRMSLE: {valid_rmsle}")
-    valid_r2 = model.score(X=X_valid, y=y_valid)
-    results['Valid R^2'] = valid_r2
-    print(f"\tR^2: {valid_r2}")
-
-    return results
\ No newline at end of file
+            results[f'{key_prefix} RMSLE'] = metrics['RMSLE'][0]
+            print(f"\tRMSLE: {metrics['RMSLE'][0]}")
+        results[f'{key_prefix} R^2'] = metrics['R^2'][0]
+        print(f"\tR^2: {metrics['R^2'][0]}")
+
+    return results
+
+def _grouped_interval_stats(residuals: np.ndarray, 
+                            codes: np.ndarray, 
+                            n_groups: int, 
+                            quantiles: Tuple[float, float], 
+                            bounds: Tuple[float, float]) -> dict[str, np.ndarray]:
+    """
+    Computes, for every group at once, the empirical residual (y_true - y_pred) quantiles and the fraction of
+    records whose residual falls within the calibrated interval bounds, i.e. whose label lies within
+    [y_pred + bounds[0], y_pred + bounds[1]].
+    """
+
+    group_quantiles = (pd.Series(residuals)
+                       .groupby(codes)
+                       .quantile(list(quantiles))
+                       .unstack()
+                       .reindex(range(n_groups)))
+    covered = (residuals >= bounds[0]) & (residuals <= bounds[1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coverage = np.bincount(codes, weights=covered, minlength=n_groups) / np.bincount(codes, minlength=n_groups)
+
+    return {
+        'residual_q_low': group_quantiles[quantiles[0]].values,
+        'residual_q_high': group_quantiles[quantiles[1]].values,
+        'interval_coverage': coverage,
+    }
+
+def evaluate_models(models: dict[str, ScikitModel], 
+                    snapshots: dict[str, tuple], 
+                    chunk_size: int = EVAL_CHUNK_SIZE, 
+                    interval: float = 0.8, 
+                    calibration_snapshot: Optional[str] = None) -> pd.DataFrame:
+    """
+    Batched evaluation of several models on several datasets (e.g. train/valid sets or different scraped snapshots).
+    Each model runs a single chunked prediction pass per snapshot, all metrics (MAE, RMSLE, R^2) and
+    prediction-interval statistics are then computed from that pass, overall as well as per segment.
+    Segment group indices are computed once per snapshot and reused for every model.
+
+    Prediction intervals are empirical: the (1-interval)/2 and (1+interval)/2 quantiles of the residuals
+    (y_true - y_pred) on the calibration snapshot give bounds [lo, hi] such that a price is predicted to lie
+    in [y_pred + lo, y_pred + hi]. Every group reports its own residual quantiles and the coverage of the
+    calibrated interval (ideally close to interval on snapshots other than the calibration one).
+
+    Parameters
+    ----------
+    models: dict[str, ScikitModel]
+        Dictionary mapping model names to fitted models (anything with a .predict() method).
+    snapshots: dict[str, tuple]
+        Dictionary mapping snapshot names to (X, y) or (X, y, segments) tuples, where segments is a
+        DF aligned with X whose columns hold the segment keys of each record, e.g. the pre-encoding
+        'locality' and 'property_type' columns. A 'price_band' segment (see PRICE_BANDS) is always added.
+    chunk_size: int
+        Number of rows passed to model.predict() at once.
+    interval: float
+        Nominal coverage of the prediction intervals.
+    calibration_snapshot: Optional[str]
+        Name of the snapshot the interval bounds are calibrated on, e.g. a validation set.
+        Defaults to the first snapshot.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per (model, snapshot, segment, group) with the number of records, the metrics and
+        the interval statistics. The overall metrics have segment and group 'all'.
+    """
+
+    quantiles = ((1 - interval) / 2, (1 + interval) / 2)
+    calibration_snapshot = calibration_snapshot or next(iter(snapshots))
+    if calibration_snapshot not in snapshots:
+        raise Exception(f'Calibration snapshot ({calibration_snapshot}) is not one of the evaluated snapshots.')
+    # calibration snapshot first, so its bounds are known before any other snapshot is evaluated
+    snapshot_order = [calibration_snapshot] + [name for name in snapshots if name != calibration_snapshot]
+
+    rows = []
+    interval_bounds = {}
+    for snapshot_name in snapshot_order:
+        snapshot = snapshots[snapshot_name]
+        X, y = snapshot[0], np.asarray(snapshot[1], dtype=float)
+        segments_df = snapshot[2] if len(snapshot) > 2 else None
+
+        # precompute the group indices of every segment, shared by all models
+        segment_indices = [('all', np.zeros(len(y), dtype=int), np.array(['all']))]
+        if segments_df is not None:
+            for segment_name, keys in segments_df.items():
+                segment_indices.append((segment_name, *_group_indices(keys.values)))
+        segment_indices.append(('price_band', *_price_band_indices(y)))
+
+        for model_name, model in models.items():
+            preds = _predict_chunked(model, X, chunk_size)
+            residuals = y - preds
+            if snapshot_name == calibration_snapshot:
+                interval_bounds[model_name] = tuple(np.quantile(residuals, quantiles))
+
+            for segment_name, codes, labels in segment_indices:
+                metrics = _grouped_metrics(y, preds, codes, len(labels))
+                metrics.update(_grouped_interval_stats(residuals, codes, len(labels), quantiles, interval_bounds[model_name]))
+                for i, label in enumerate(labels):
+                    # skip empty groups (e.g. price bands without any records)
+                    if not metrics['n'][i]:
+                        continue
+                    rows.append({
+                        'model': model_name,
+                        'snapshot': snapshot_name,
+                        'segment': segment_name,
+                        'group': label,
+                        **{metric: values[i] for metric, values in metrics.items()},
+                        'interval_low': interval_bounds[model_name][0],
+                        'interval_high': interval_bounds[model_name][1],
+                    })
+
+    return pd.DataFrame(rows)